@@ -3,6 +3,7 @@
 # the full copyright notices and license terms.
 
 from trytond.pool import Pool
+from . import ir
 from . import price_list
 from . import product
 from . import invoice
@@ -16,15 +17,26 @@ def register():
         price_list.PriceList,
         price_list.PriceListLine,
         price_list.Currency,
+        price_list.CurrencyRate,
+        price_list.PriceListSnapshot,
         product.Product,
         invoice.Invoice,
         invoice.InvoiceLine,
         invoice.InvoiceUpdateLinePriceStart,
+        invoice.InvoiceUpdateLinePriceDone,
         sale.Sale,
         sale.Line,
         price_list.ProductPriceRecomputeStart,
+        price_list.ProductPriceRecomputeDone,
+        price_list.PriceListImportStart,
+        price_list.PriceListImportDone,
+        ir.Cron,
         module='product_price_list_ar', type_='model')
     Pool.register(
         invoice.InvoiceUpdateLinePrice,
         price_list.ProductPriceRecompute,
+        price_list.PriceListImport,
         module='product_price_list_ar', type_='wizard')
+    Pool.register(
+        price_list.ProductPriceRecomputePreview,
+        module='product_price_list_ar', type_='report')
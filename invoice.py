@@ -1,6 +1,7 @@
 # This file is part of product_price_list_ar module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from collections import defaultdict
 from decimal import Decimal
 
 from trytond.model import fields, ModelView
@@ -9,6 +10,10 @@ from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Bool, Equal, Eval, Not, Or
 from trytond.transaction import Transaction
 
+from .price_list import quantize_rate, rate_digits
+from .pricing import PricingContext
+from .stats import instrumented
+
 
 class Invoice(metaclass=PoolMeta):
     __name__ = 'account.invoice'
@@ -39,11 +44,12 @@ class Invoice(metaclass=PoolMeta):
 
     @fields.depends('currency', 'company')
     def on_change_currency(self):
+        digits = self.__class__.currency_rate.digits or rate_digits
         if self.currency and self.currency.rate:
-            self.currency_rate = (
-                self.company.currency.rate / self.currency.rate)
+            self.currency_rate = quantize_rate(
+                self.company.currency.rate / self.currency.rate, digits)
         else:
-            self.currency_rate = Decimal('1.0')
+            self.currency_rate = quantize_rate(1, digits)
 
     @fields.depends('type', 'price_list', 'party',
         '_parent_party.sale_price_list')
@@ -56,12 +62,80 @@ class Invoice(metaclass=PoolMeta):
         else:
             self.price_list = None
 
+    @fields.depends('currency', 'currency_rate', 'party', 'invoice_date',
+        'price_list')
+    def _get_pricing_context(self):
+        "Return the pricing context shared by the lines"
+        context = {}
+        if self.currency:
+            context['currency'] = self.currency.id
+        if self.currency_rate:
+            context['currency_rate'] = self.currency_rate
+        if self.party:
+            context['customer'] = self.party.id
+        if self.invoice_date:
+            context['sale_date'] = self.invoice_date
+        if self.price_list:
+            context['price_list'] = self.price_list.id
+        return PricingContext(context)
+
     @classmethod
     @ModelView.button_action(
         'product_price_list_ar.wiz_invoice_update_line_price')
     def update_line_price(cls, invoices):
         pass
 
+    @classmethod
+    def update_lines_price(cls, invoices):
+        '''
+        Update the unit price of the lines of the draft customer invoices
+        with their price list, lines sharing the same pricing context are
+        priced at once
+        Return the lines that changed
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        InvoiceLine = pool.get('account.invoice.line')
+
+        invoices = [i for i in invoices
+            if i.state == 'draft' and i.type == 'out']
+        groups = defaultdict(lambda: defaultdict(list))
+        for invoice in invoices:
+            lines = [l for l in invoice.lines
+                if l.type == 'line' and l.product]
+            if invoice.price_list:
+                defined = invoice.price_list.products_defined(
+                    [l.product for l in lines])
+                lines = [l for l in lines if l.product.id in defined]
+            document = invoice._get_pricing_context()
+            for line in lines:
+                context = line._get_pricing_context(document)
+                groups[context, line.quantity or 0][line.product].append(
+                    line)
+
+        digits = InvoiceLine.unit_price.digits[1]
+        to_save = []
+        for (context, quantity), product_lines in groups.items():
+            with Transaction().set_context(dict(context)):
+                prices = Product.get_sale_price(
+                    list(product_lines), quantity)
+            for product, lines in product_lines.items():
+                unit_price = prices[product.id]
+                if unit_price is not None:
+                    unit_price = unit_price.quantize(
+                        Decimal(1) / 10 ** digits)
+                for line in lines:
+                    old_values = (line.unit_price, line.amount)
+                    line.unit_price = unit_price
+                    line.amount = line.on_change_with_amount()
+                    if (line.unit_price, line.amount) != old_values:
+                        to_save.append(line)
+
+        if to_save:
+            InvoiceLine.save(to_save)
+            cls.update_taxes(list({l.invoice for l in to_save}))
+        return to_save
+
 
 class InvoiceLine(metaclass=PoolMeta):
     __name__ = 'account.invoice.line'
@@ -72,33 +146,36 @@ class InvoiceLine(metaclass=PoolMeta):
         cls.product.context['currency_rate'] = Eval(
             '_parent_invoice', {}).get('currency_rate')
 
-    def _get_context_invoice_price(self):
-        context = {}
-        if getattr(self, 'invoice', None):
-            if getattr(self, 'currency', None):
-                context['currency'] = self.currency.id
-            if getattr(self.invoice, 'currency_rate', None):
-                context['currency_rate'] = self.invoice.currency_rate
-            if getattr(self.invoice, 'party', None):
-                context['customer'] = self.invoice.party.id
-            if getattr(self.invoice, 'invoice_date', None):
-                context['sale_date'] = self.invoice.invoice_date
-            if getattr(self.invoice, 'price_list', None):
-                context['price_list'] = self.invoice.price_list.id
-                context['price_list_currency'] = (
-                    self.invoice.price_list.currency.id)
+    # Invoice lines have no price list, rate nor date of their own so the
+    # parent fields read by Invoice._get_pricing_context are needed
+    @fields.depends('invoice', 'unit', 'product', 'taxes',
+        '_parent_invoice.currency', '_parent_invoice.currency_rate',
+        '_parent_invoice.party', '_parent_invoice.invoice_date',
+        '_parent_invoice.price_list')
+    def _get_pricing_context(self, document=None):
+        '''
+        Return the pricing context of the line
+        extending the pricing context of the invoice if given
+        '''
+        if document is None:
+            document = PricingContext()
+            if getattr(self, 'invoice', None):
+                document = self.invoice._get_pricing_context()
         if self.unit:
-            context['uom'] = self.unit.id
+            uom = self.unit.id
         else:
-            context['uom'] = self.product.sale_uom.id
-        context['taxes'] = [t.id for t in self.taxes]
+            uom = self.product.sale_uom.id
+        return document.merge(uom=uom, taxes=[t.id for t in self.taxes])
+
+    @fields.depends(methods=['_get_pricing_context'])
+    def _get_context_invoice_price(self):
+        context = dict(self._get_pricing_context())
+        context['taxes'] = list(context['taxes'])
         return context
 
-    @fields.depends('product', 'unit', 'invoice_type', 'invoice',
-        '_parent_invoice.type', 'unit_price', '_parent_invoice.currency',
-        '_parent_invoice.currency_rate', '_parent_invoice.party',
-        '_parent_invoice.invoice_date', '_parent_invoice.price_list',
-        methods=['on_change_with_amount'])
+    @fields.depends('product', 'quantity', 'invoice_type', 'invoice',
+        '_parent_invoice.type',
+        methods=['_get_context_invoice_price', 'on_change_with_amount'])
     def on_change_product(self):
         pool = Pool()
         Product = pool.get('product.product')
@@ -128,6 +205,13 @@ class InvoiceUpdateLinePriceStart(ModelView):
     __name__ = 'invoice.update_line_price.start'
 
 
+class InvoiceUpdateLinePriceDone(ModelView):
+    'Invoice Update Line Price Done'
+    __name__ = 'invoice.update_line_price.done'
+
+    lines = fields.Integer('Updated Lines', readonly=True)
+
+
 class InvoiceUpdateLinePrice(Wizard):
     'Invoice Update Line Price'
     __name__ = 'invoice.update_line_price'
@@ -138,18 +222,21 @@ class InvoiceUpdateLinePrice(Wizard):
             Button('Update', 'update', 'tryton-ok', default=True),
             ])
     update = StateTransition()
+    done = StateView('invoice.update_line_price.done',
+        'product_price_list_ar.invoice_update_line_price_done_view_form', [
+            Button('OK', 'end', 'tryton-ok', default=True),
+            ])
 
+    @instrumented('invoice.update_line_price')
     def transition_update(self):
         AccountInvoice = Pool().get('account.invoice')
 
-        invoice = AccountInvoice(Transaction().context['active_id'])
-        price_list = invoice.price_list
-        for line in invoice.lines:
-            if (price_list and price_list.product_defined(line.product)
-                    is False):
-                continue
-            line.on_change_product()
-            line.save()
-
-        AccountInvoice.update_taxes([invoice])
-        return 'end'
+        lines = AccountInvoice.update_lines_price(
+            self.records or [self.record])
+        self.done.lines = len(lines)
+        return 'done'
+
+    def default_done(self, fields):
+        return {
+            'lines': self.done.lines,
+            }
@@ -1,15 +1,75 @@
 # This file is part of product_price_list_ar module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import csv
+import io
+import logging
+import re
+from bisect import bisect_right
+from collections import defaultdict
 from decimal import Decimal, ROUND_HALF_UP
-from sql import Table
+from functools import lru_cache
+from itertools import islice, product as iproduct
+from simpleeval import SimpleEval
+from sql import Null, Table
+from sql.conditionals import Case
+from sql.functions import CurrentTimestamp
 
-from trytond.model import fields, ModelView
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.model import fields, Index, ModelSQL, ModelView
 from trytond.modules.product import price_digits
+from trytond.modules.product_price_list.price_list import Null as NullPrice
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.report import Report
+from trytond.rpc import RPC
+from trytond.tools import decistmt, grouped_slice, reduce_ids
 from trytond.transaction import Transaction
-from trytond.wizard import Wizard, StateView, StateTransition, Button
+from trytond.wizard import (
+    Wizard, StateView, StateTransition, StateReport, Button)
+
+from .stats import get_stats, instrumented, reset_stats
+
+logger = logging.getLogger(__name__)
+_NUMERIC_FORMULA = re.compile(r'^\s*[-+]?(\d+(\.\d*)?|\.\d+)\s*$')
+rate_digits = (16, config.getint(
+        'product_price_list_ar', 'rate_decimal', default=10))
+percentage_digits = (16, 4)
+
+
+def quantize_rate(rate, digits=rate_digits):
+    "Return the rate as Decimal with a fixed number of digits"
+    if not isinstance(rate, Decimal):
+        rate = Decimal(str(rate))
+    return rate.quantize(Decimal(1) / 10 ** digits[1])
+
+
+def is_numeric_formula(formula):
+    "Test if the formula is a plain number"
+    return bool(formula) and bool(_NUMERIC_FORMULA.match(str(formula)))
+
+
+def same_formula(formula, other):
+    "Test if the formulas are equal or are the same number"
+    if formula == other:
+        return True
+    return (is_numeric_formula(formula) and is_numeric_formula(other)
+        and Decimal(str(formula)) == Decimal(str(other)))
+
+
+@lru_cache(maxsize=config.getint(
+        'product_price_list_ar', 'formula_cache', default=10000))
+def parse_formula(formula):
+    '''
+    Return the formula as Decimal if it is a plain number
+    otherwise its parsed expression
+    '''
+    if is_numeric_formula(formula):
+        return Decimal(formula.strip())
+    return SimpleEval.parse(decistmt(formula))
 
 
 class PriceList(metaclass=PoolMeta):
@@ -18,6 +78,25 @@ class PriceList(metaclass=PoolMeta):
 
     currency = fields.Many2One('currency.currency', 'Currency',
         required=True)
+    snapshot = fields.Boolean('Snapshot',
+        help="Store the prices of the products of the list "
+        "in its currency and the company currency for fast lookups.")
+    _products_cache = Cache('product.price_list.products_defined',
+        context=False)
+    _line_index_cache = Cache('product.price_list.line_index',
+        context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.__rpc__.update({
+                'get_pricing_stats': RPC(),
+                'quote': RPC(),
+                })
+
+    @staticmethod
+    def default_snapshot():
+        return False
 
     @staticmethod
     def default_currency():
@@ -31,86 +110,481 @@ class PriceList(metaclass=PoolMeta):
         If the product is defined in the list
         or in the parent list, then return True
         '''
-        cursor = Transaction().connection.cursor()
-        lines = Table('product_price_list_line')
+        return bool(product) and (
+            product.id in self.products_defined([product]))
 
-        cursor.execute(*lines.select(lines.id,
-            where=(lines.product == product.id) &
-                (lines.price_list == self.id)))
-        if cursor.fetchall():
-            return True
-        return False
+    @instrumented('product.price_list.products_defined')
+    def products_defined(self, products):
+        '''
+        Return the set of product ids defined in the list
+        '''
+        defined = self._products_cache.get(self.id)
+        if defined is None:
+            cursor = Transaction().connection.cursor()
+            lines = Table('product_price_list_line')
 
-    def get_context_formula(self, product, quantity, uom, pattern=None):
-        pool = Pool()
-        PriceList = pool.get('product.price_list')
-        Currency = pool.get('currency.currency')
+            cursor.execute(*lines.select(lines.product,
+                where=(lines.price_list == self.id)
+                & (lines.product != Null),
+                group_by=[lines.product]))
+            defined = frozenset(p for p, in cursor)
+            self._products_cache.set(self.id, defined)
+        return defined & {p.id for p in products if p}
+
+    @classmethod
+    def delete(cls, price_lists):
+        super().delete(price_lists)
+        cls._products_cache.clear()
+        cls._line_index_cache.clear()
+
+    @classmethod
+    def get_pricing_stats(cls, reset=False):
+        '''
+        Return the calls, time and queries recorded by the instrumented
+        pricing methods of this process
+        '''
+        stats = get_stats()
+        if reset:
+            reset_stats()
+        return stats
+
+    @classmethod
+    @instrumented('product.price_list.quote')
+    def quote(cls, price_list, items, currency, currency_rate=None,
+            customer=None, offset=0, limit=None):
+        '''
+        Return the sale prices with the price list of the items
+        from offset to limit in the currency
+        Items are (product, quantity, uom) with uom optional,
+        the prices are returned as a list in the same order
+        Items sharing quantity and uom are priced at once
+        '''
+        Product = Pool().get('product.product')
+
+        items = items[offset:offset + limit if limit else None]
+        groups = defaultdict(list)
+        for i, (product, quantity, *uom) in enumerate(items):
+            uom = int(uom[0]) if uom and uom[0] else None
+            groups[quantity or 0, uom].append((i, int(product)))
+
+        context = {
+            'price_list': int(price_list),
+            'currency': int(currency),
+            'currency_rate': currency_rate,
+            'customer': int(customer) if customer else None,
+            }
+        prices = [None] * len(items)
+        for (quantity, uom), entries in groups.items():
+            products = Product.browse(list({p for _, p in entries}))
+            with Transaction().set_context(context, uom=uom):
+                unit_prices = Product.get_sale_price(products, quantity)
+            for i, product in entries:
+                prices[i] = unit_prices[product]
+        return prices
 
+    @instrumented('product.price_list.get_context_formula')
+    def get_context_formula(self, product, quantity, uom, pattern=None):
         res = super().get_context_formula(product, quantity, uom, pattern)
 
-        context = Transaction().context
-        if context.get('price_list') and context.get('currency'):
-            price_list = PriceList(context.get('price_list'))
-            currency = Currency(context.get('currency'))
-            if price_list.currency != currency:
-                if price_list.currency.rate != 0:
-                    rate = Decimal(str(
-                        currency.rate / price_list.currency.rate))
-                    if isinstance(res['names']['unit_price'], Decimal):
-                        res['names']['unit_price'] /= rate
-                    if isinstance(res['names']['cost_price'], Decimal):
-                        res['names']['cost_price'] /= rate
-                    if isinstance(res['names']['list_price'], Decimal):
-                        res['names']['list_price'] /= rate
+        rate = self.get_context_currency_rate()
+        if rate is not None:
+            if isinstance(res['names']['unit_price'], Decimal):
+                res['names']['unit_price'] /= rate
+            if isinstance(res['names']['cost_price'], Decimal):
+                res['names']['cost_price'] /= rate
+            if isinstance(res['names']['list_price'], Decimal):
+                res['names']['list_price'] /= rate
         return res
 
-    def compute(self, product, quantity, uom, pattern=None):
-        'Compute price based price list currency'
-        pool = Pool()
-        PriceList = pool.get('product.price_list')
-        Currency = pool.get('currency.currency')
+    def get_currency_rate(self):
+        '''
+        Return the rate to convert prices from the price list currency
+        to the currency of the context or None if no conversion is needed
+        '''
+        Currency = Pool().get('currency.currency')
 
-        unit_price = super().compute(product, quantity, uom, pattern)
+        context = Transaction().context
+        if self.currency.id == int(context['currency']):
+            return None
+        currency_rate = context.get('currency_rate')
+        # currency_rate = 1 can not be used
+        if currency_rate and int(currency_rate) == 1:
+            currency_rate = None
+        rate = Currency.get_price_list_rate(
+            self.currency, context['currency'], currency_rate)
+        return rate or None
+
+    def _get_context_price_list(self):
+        PriceList = Pool().get('product.price_list')
 
         context = Transaction().context
         if context.get('price_list') and context.get('currency'):
-            price_list = PriceList(context.get('price_list'))
-            if price_list.product_defined(product) is False:
+            if int(context['price_list']) == self.id:
+                return self
+            return PriceList(context.get('price_list'))
+
+    def get_context_currency_rate(self):
+        '''
+        Return the rate of the price list of the context
+        It is the single conversion used to compute prices
+        '''
+        context = Transaction().context
+        if '_price_list_currency_rate' in context:
+            return context['_price_list_currency_rate']
+        price_list = self._get_context_price_list()
+        if price_list:
+            return price_list.get_currency_rate()
+
+    @instrumented('product.price_list.get_line_index')
+    def get_line_index(self):
+        '''
+        Return the index of the lines by (product, category)
+        Each entry is the sorted list of quantity breaks and, for each break,
+        the (position, line id) of the first line among the lines of
+        lower or equal quantity
+        '''
+        index = self._line_index_cache.get(self.id)
+        if index is None:
+            Line = Pool().get('product.price_list.line')
+            breaks = defaultdict(list)
+            lines = Line.search_read([('price_list', '=', self.id)],
+                fields_names=['product', 'category', 'quantity'])
+            for position, line in enumerate(lines):
+                breaks[line['product'], line['category']].append(
+                    (line['quantity'] or 0, position, line['id']))
+            index = {}
+            for key, values in breaks.items():
+                values.sort()
+                quantities, firsts, first = [], [], None
+                for quantity, position, line_id in values:
+                    if first is None or position < first[0]:
+                        first = (position, line_id)
+                    quantities.append(quantity)
+                    firsts.append(first)
+                index[key] = (quantities, firsts)
+            self._line_index_cache.set(self.id, index)
+        return index
+
+    def get_line(self, pattern):
+        '''
+        Return the first line matching the pattern of a product
+        The candidate is found by binary search in the line index
+        and the lines are only scanned if it does not match other criteria
+        '''
+        Line = Pool().get('product.price_list.line')
+
+        index = self.get_line_index()
+        quantity = abs(pattern.get('quantity') or 0)
+        first = None
+        for key in iproduct([pattern['product'], None],
+                [None] + list(pattern.get('categories', []))):
+            if key not in index:
+                continue
+            quantities, firsts = index[key]
+            i = bisect_right(quantities, quantity)
+            if i and (first is None or firsts[i - 1] < first):
+                first = firsts[i - 1]
+        if first is None:
+            return
+        position, line_id = first
+        line = Line(line_id)
+        if line.match(pattern):
+            return line
+        for line in self.lines[position + 1:]:
+            if line.match(pattern):
+                return line
+
+    def compute_line(self, product, quantity, uom, pattern=None):
+        '''
+        Compute the price of the product with the line found by get_line
+        It is the parent compute without its linear scan of the lines
+        '''
+        Uom = Pool().get('product.uom')
+
+        if not product:
+            return super().compute(product, quantity, uom, pattern)
+
+        pattern = pattern.copy() if pattern else {}
+        categories = []
+        for category in product.categories_all:
+            while category:
+                categories.append(category.id)
+                category = category.parent
+        pattern['categories'] = categories
+        pattern['product'] = product.id
+        pattern['quantity'] = Uom.compute_qty(uom, quantity,
+            self.get_uom(product), round=False)
+
+        context = self.get_context_formula(
+            product, quantity, uom, pattern=pattern)
+        line = self.get_line(pattern)
+        if line:
+            unit_price = line.get_unit_price(**context)
+            if isinstance(unit_price, NullPrice):
+                unit_price = None
+            return unit_price
+
+    @instrumented('product.price_list.compute')
+    def compute(self, product, quantity, uom, pattern=None):
+        'Compute price based price list currency'
+        unit_price = self.compute_line(product, quantity, uom, pattern)
+
+        price_list = self._get_context_price_list()
+        if price_list and unit_price is not None:
+            if not price_list.product_defined(product):
                 return unit_price
-            currency = Currency(context.get('currency'))
-            if price_list.currency != currency:
-                rate = None
-                if context.get('currency_rate'):
-                    if int(context.get('currency_rate')) == 1:
-                        # currency_rate = 1 can not be used
-                        if price_list.currency.rate == 0:
-                            rate = Decimal('1.0')
-                        else:
-                            rate = Decimal(str(
-                                currency.rate / price_list.currency.rate))
-                    else:
-                        rate = Decimal(context.get('currency_rate'))
-                else:
-                    # Calculate rate from currencies
-                    if price_list.currency.rate == 0:
-                        rate = Decimal('1.0')
-                    else:
-                        rate = Decimal(str(
-                            currency.rate / price_list.currency.rate))
+            rate = self.get_context_currency_rate()
+            if rate is not None:
                 unit_price *= rate
-
         return unit_price
 
+    @instrumented('product.price_list.compute_many')
+    def compute_many(self, products, quantity, uom, pattern=None):
+        '''
+        Compute the price of many products in a single pass
+        The products are priced with compute, the defined products and the
+        currency rate of the context price list being looked up only once
+        The product sale unit is used when uom is missing or of another
+        category
+        Return a dictionary with product id as key
+        '''
+        context = {}
+        price_list = self._get_context_price_list()
+        if price_list:
+            # Fill the cache of the defined products
+            price_list.products_defined(products)
+            context['_price_list_currency_rate'] = (
+                price_list.get_currency_rate())
+
+        prices = {}
+        with Transaction().set_context(context):
+            for product in products:
+                product_uom = uom or product.sale_uom
+                if product_uom.category != product.sale_uom.category:
+                    product_uom = product.sale_uom
+                prices[product.id] = self.compute(
+                    product, quantity, product_uom, pattern)
+        return prices
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        actions = iter(args)
+        to_refresh = set()
+        for price_lists, values in zip(actions, actions):
+            if 'snapshot' in values:
+                to_refresh.update(price_lists)
+            elif values.keys() & {'currency', 'company', 'price', 'unit'}:
+                to_refresh.update(p for p in price_lists if p.snapshot)
+        cls.queue_refresh_snapshot({p: None for p in to_refresh})
+
+    @classmethod
+    def queue_refresh_snapshot(cls, scope):
+        '''
+        Push a refresh task of the snapshot for each price list of the scope
+        Scope is a dictionary of price list with the product ids to refresh
+        as value, None meaning all the products
+        '''
+        for price_list, products in scope.items():
+            if products is not None:
+                products = sorted(products)
+            cls.__queue__.refresh_snapshot([price_list], products=products)
+
+    @classmethod
+    def refresh_snapshot(cls, price_lists, products=None):
+        '''
+        Replace the snapshot of the price lists for the products
+        (all the products defined in the list if None) by their price
+        at each quantity break in the currency of the list and of its company
+        '''
+        pool = Pool()
+        Line = pool.get('product.price_list.line')
+        Product = pool.get('product.product')
+        Snapshot = pool.get('product.price_list.snapshot')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        line = Line.__table__()
+        snapshot = Snapshot.__table__()
+
+        if products is not None:
+            products = {int(p) for p in products}
+        exp = Decimal(1) / 10 ** price_digits[1]
+        columns = [snapshot.price_list, snapshot.product, snapshot.currency,
+            snapshot.quantity, snapshot.unit_price,
+            snapshot.create_date, snapshot.create_uid]
+        for price_list in price_lists:
+            where = snapshot.price_list == price_list.id
+            if products is None:
+                cursor.execute(*snapshot.delete(where=where))
+            else:
+                for sub_ids in grouped_slice(products):
+                    cursor.execute(*snapshot.delete(
+                            where=where & reduce_ids(
+                                snapshot.product, list(sub_ids))))
+            if not price_list.snapshot:
+                continue
+
+            where = line.price_list == price_list.id
+            cursor.execute(*line.select(line.product,
+                    where=where & (line.product != Null),
+                    group_by=[line.product]))
+            defined = {p for p, in cursor}
+            if products is not None:
+                defined &= products
+            cursor.execute(*line.select(line.quantity,
+                    where=where & (line.quantity != Null),
+                    group_by=[line.quantity]))
+            quantities = sorted({0} | {abs(q) for q, in cursor})
+            currencies = {price_list.currency, price_list.company.currency}
+
+            for sub_products in grouped_slice(sorted(defined)):
+                uoms = defaultdict(list)
+                for product in Product.browse(list(sub_products)):
+                    uoms[price_list.get_uom(product)].append(product)
+                values = []
+                for currency in currencies:
+                    with transaction.set_context(
+                            price_list=price_list.id, currency=currency.id,
+                            currency_rate=None,
+                            company=price_list.company.id):
+                        for uom, uom_products in uoms.items():
+                            previous = {}
+                            for quantity in quantities:
+                                prices = price_list.compute_many(
+                                    uom_products, quantity, uom)
+                                for product_id, price in prices.items():
+                                    if price is not None:
+                                        price = price.quantize(exp)
+                                    if (product_id in previous
+                                            and previous[product_id] == price):
+                                        continue
+                                    previous[product_id] = price
+                                    values.append([price_list.id, product_id,
+                                            currency.id, quantity, price,
+                                            CurrentTimestamp(),
+                                            transaction.user])
+                # Each row takes 6 parameters
+                for sub_values in grouped_slice(
+                        values, transaction.database.IN_MAX // 6):
+                    cursor.execute(*snapshot.insert(
+                            columns, list(sub_values)))
+            logger.info("refresh snapshot of price list %s: %s products",
+                price_list.id, len(defined))
+
+    @classmethod
+    def refresh_snapshots(cls):
+        "Refresh the snapshot of all the price lists"
+        cls.refresh_snapshot(cls.search([('snapshot', '=', True)]))
+
+    @classmethod
+    def queue_refresh_snapshot_currencies(cls, currencies):
+        '''
+        Push a refresh task of the snapshot of the price lists converted
+        from or to the currencies
+        '''
+        currencies = {int(c) for c in currencies}
+        scope = {}
+        for price_list in cls.search([('snapshot', '=', True)]):
+            used = {price_list.currency.id, price_list.company.currency.id}
+            if len(used) > 1 and used & currencies:
+                scope[price_list] = None
+        cls.queue_refresh_snapshot(scope)
+
+    def get_snapshot_prices(self, products, quantity=0, uom=None):
+        '''
+        Return the snapshot price of the products for the quantity in the
+        currency of the context as a dictionary with product id as key
+        Products missing from the snapshot are not in the dictionary
+        '''
+        Snapshot = Pool().get('product.price_list.snapshot')
+        return Snapshot.get_prices(self, products,
+            Transaction().context['currency'], quantity=quantity, uom=uom)
+
 
 class PriceListLine(metaclass=PoolMeta):
     'Price List Line'
     __name__ = 'product.price_list.line'
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(
+                t,
+                (t.price_list, Index.Range()),
+                (t.product, Index.Range())))
+
+    @classmethod
+    def create(cls, vlist):
+        PriceList = Pool().get('product.price_list')
+        lines = super().create(vlist)
+        PriceList._products_cache.clear()
+        PriceList._line_index_cache.clear()
+        PriceList.queue_refresh_snapshot(cls._get_snapshot_scope(lines))
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        PriceList = Pool().get('product.price_list')
+        actions = iter(args)
+        scope, moved, reindex = {}, [], False
+        for lines, values in zip(actions, actions):
+            cls._get_snapshot_scope(lines, scope)
+            if values.keys() & {'price_list', 'product'}:
+                moved.extend(l.id for l in lines)
+            reindex |= bool(values.keys() & {
+                    'price_list', 'product', 'category', 'quantity',
+                    'sequence'})
+        super().write(*args)
+        PriceList._products_cache.clear()
+        if reindex:
+            PriceList._line_index_cache.clear()
+        PriceList.queue_refresh_snapshot(
+            cls._get_snapshot_scope(cls.browse(moved), scope))
+
+    @classmethod
+    def delete(cls, lines):
+        PriceList = Pool().get('product.price_list')
+        scope = cls._get_snapshot_scope(lines)
+        super().delete(lines)
+        PriceList._products_cache.clear()
+        PriceList._line_index_cache.clear()
+        PriceList.queue_refresh_snapshot(scope)
+
+    @classmethod
+    def _get_snapshot_scope(cls, lines, scope=None):
+        '''
+        Return the product ids to refresh by price list with snapshot
+        None meaning all the products of the list
+        '''
+        if scope is None:
+            scope = {}
+        for line in lines:
+            price_list = line.price_list
+            if not price_list or not price_list.snapshot:
+                continue
+            if line.product and scope.get(price_list, set()) is not None:
+                scope.setdefault(price_list, set()).add(line.product.id)
+            else:
+                scope[price_list] = None
+        return scope
+
+    def get_unit_price(self, **context):
+        'Return unit price (as Decimal)'
+        formula = parse_formula(self.formula)
+        if isinstance(formula, Decimal):
+            return formula
+        context.setdefault('functions', {})['Decimal'] = Decimal
+        return SimpleEval(**context).eval(
+            self.formula, previously_parsed=formula)
+
     @classmethod
     def compute_currency(cls, from_currency, amount, to_currency,
             currency_rate, round=True):
         pool = Pool()
         Company = pool.get('company.company')
+        Currency = pool.get('currency.currency')
 
         if to_currency == from_currency:
             if round:
@@ -118,40 +592,201 @@ class PriceListLine(metaclass=PoolMeta):
             else:
                 return amount
 
+        rate = Currency.get_price_list_rate(
+            from_currency, to_currency, currency_rate)
+        # an explicit currency_rate is the company currency per unit of the
+        # other currency while the computed rate is from_currency to
+        # to_currency
         company = Company(Transaction().context['company'])
-        if from_currency == company.currency:
-            from_currency_rate = currency_rate
-            currency_rate = Decimal('1.0')
+        if currency_rate and from_currency == company.currency:
+            amount /= rate
         else:
-            from_currency_rate = Decimal('1.0')
+            amount *= rate
 
         if round:
-            return to_currency.round(
-                amount * currency_rate / from_currency_rate)
+            return to_currency.round(amount)
         else:
-            return amount * currency_rate / from_currency_rate
+            return amount
 
     @classmethod
-    def _recompute_price_by_fixed_amount(cls, line, new_unit_price):
-        values = {
-            'formula': new_unit_price,
-            }
-        return values
+    def iter_recompute(cls, price_list, products=None, size=None):
+        '''
+        Yield the lines of the price list to recompute by chunks of size
+        with their formula and product already read
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        if not size:
+            size = Transaction().database.IN_MAX
+        where = table.price_list == price_list.id
+        if products:
+            wheres = [where & reduce_ids(
+                    table.product, [p.id for p in sub_products])
+                for sub_products in grouped_slice(products)]
+        else:
+            wheres = [where]
+        for where in wheres:
+            last_id = 0
+            while True:
+                cursor.execute(*table.select(
+                        table.id, table.formula, table.product,
+                        where=where & (table.id > last_id),
+                        order_by=[table.id.asc], limit=size))
+                lines = [cls(id_, formula=formula, product=product)
+                    for id_, formula, product in cursor]
+                if not lines:
+                    break
+                yield lines
+                last_id = lines[-1].id
 
     @classmethod
-    def recompute_price_by_fixed_amount(cls, lines, unit_price):
+    def recompute_price(cls, lines, method, **kwargs):
+        '''
+        Recompute lines with the recompute_price_by_<method> method
+        Return the number of updated and skipped lines
+        '''
+        return getattr(cls, 'recompute_price_by_%s' % method)(
+            lines, **kwargs)
+
+    @classmethod
+    def recompute_price_list(cls, price_list, method, products=None,
+            size=None, queue=False, **kwargs):
+        '''
+        Recompute the lines of the price list by chunks of size
+        When queue is set, each chunk is pushed as a task of the queue
+        Return the number of updated, skipped and queued lines
+        '''
+        if not size:
+            size = config.getint(
+                'product_price_list_ar', 'recompute_size', default=1000)
+        updated = skipped = queued = 0
+        for count, lines in enumerate(
+                cls.iter_recompute(price_list, products, size), 1):
+            if queue:
+                cls.__queue__.recompute_price(lines, method, **kwargs)
+                queued += len(lines)
+            else:
+                line_updated, line_skipped = cls.recompute_price(
+                    lines, method, **kwargs)
+                updated += line_updated
+                skipped += line_skipped
+            logger.info(
+                "recompute price list %s: chunk %s, %s lines processed",
+                price_list.id, count, updated + skipped + queued)
+        return updated, skipped, queued
+
+    @classmethod
+    def recompute_price_lists(cls, price_lists, method, products=None,
+            size=None, queue=False, **kwargs):
+        '''
+        Recompute the lines of each price list by chunks of size
+        When queue is set, the chunks of all the lists are pushed as tasks
+        of the queue which run in their own transaction and in parallel on
+        the queue workers
+        Return the combined number of updated, skipped and queued lines
+        '''
+        updated = skipped = queued = 0
+        for price_list in price_lists:
+            list_updated, list_skipped, list_queued = (
+                cls.recompute_price_list(price_list, method,
+                    products=products, size=size, queue=queue, **kwargs))
+            updated += list_updated
+            skipped += list_skipped
+            queued += list_queued
+        logger.info(
+            "recompute %s price lists: %s updated, %s skipped, %s queued",
+            len(price_lists), updated, skipped, queued)
+        return updated, skipped, queued
+
+    @classmethod
+    def _write_recomputed_price(cls, to_write):
+        '''
+        Write the recomputed values
+        Numeric formulas replaced by numeric formulas are updated by chunks
+        with one query setting the new value of each line and the others are
+        grouped by their new values and written with the ORM
+        Return the number of written lines
+        '''
+        pool = Pool()
+        PriceList = pool.get('product.price_list')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        to_update = {}
+        to_save = defaultdict(list)
+        actions = iter(to_write)
+        for lines, values in zip(actions, actions):
+            if (set(values) == {'formula'}
+                    and is_numeric_formula(values['formula'])
+                    and all(is_numeric_formula(l.formula) for l in lines)):
+                to_update.update(
+                    (l.id, str(values['formula'])) for l in lines)
+            else:
+                to_save[tuple(sorted(values.items()))].extend(lines)
+
+        # Each line takes 3 parameters: id and value in the case and id
+        size = transaction.database.IN_MAX // 3
+        for sub_ids in grouped_slice(to_update, size):
+            sub_ids = list(sub_ids)
+            formula = Case(*((table.id == id_, to_update[id_])
+                    for id_ in sub_ids), else_=table.formula)
+            cursor.execute(*table.update(
+                    [table.formula, table.write_date, table.write_uid],
+                    [formula, CurrentTimestamp(), transaction.user],
+                    where=reduce_ids(table.id, sub_ids)))
+        if to_update:
+            transaction.counter += 1
+            for cache in transaction.cache.values():
+                cache.pop(cls.__name__, None)
+            PriceList._products_cache.clear()
+            PriceList.queue_refresh_snapshot(
+                cls._get_snapshot_scope(cls.browse(list(to_update))))
+        args = []
+        for values, lines in to_save.items():
+            args.extend((lines, dict(values)))
+        if args:
+            cls.write(*args)
+        return len(to_update) + sum(len(l) for l in to_save.values())
+
+    @classmethod
+    def _recompute_price_lines(cls, lines, get_values):
         to_write = []
         for line in lines:
-            new_values = line._recompute_price_by_fixed_amount(line,
-                unit_price)
+            new_values = get_values(line) or {}
+            if same_formula(
+                    line.formula, new_values.get('formula', line.formula)):
+                new_values.pop('formula', None)
             if new_values:
                 to_write.extend(([line], new_values))
+        updated = 0
         if to_write:
-            cls.write(*to_write)
+            updated = cls._write_recomputed_price(to_write)
+        return updated, len(lines) - updated
+
+    @classmethod
+    def _recompute_price_by_fixed_amount(cls, line, new_unit_price):
+        values = {
+            'formula': str(new_unit_price),
+            }
+        return values
+
+    @classmethod
+    def _get_recompute_price_values_fixed_amount(cls, unit_price):
+        return lambda line: cls._recompute_price_by_fixed_amount(
+            line, unit_price)
+
+    @classmethod
+    def recompute_price_by_fixed_amount(cls, lines, unit_price):
+        return cls._recompute_price_lines(lines,
+            cls._get_recompute_price_values_fixed_amount(unit_price))
 
     @classmethod
     def _recompute_price_by_percentage(cls, line, factor):
-        list_price = Decimal(line.formula)
+        if not is_numeric_formula(line.formula):
+            return
+        list_price = parse_formula(line.formula)
         new_list_price = (list_price * factor).quantize(
             Decimal('1.'), rounding=ROUND_HALF_UP)
         values = {
@@ -159,20 +794,277 @@ class PriceListLine(metaclass=PoolMeta):
             }
         return values
 
+    @classmethod
+    def _get_recompute_price_values_percentage(cls, percentage):
+        factor = 1 + quantize_rate(percentage, percentage_digits)
+        return lambda line: cls._recompute_price_by_percentage(line, factor)
+
     @classmethod
     def recompute_price_by_percentage(cls, lines, percentage):
-        to_write = []
-        factor = Decimal(1) + Decimal(percentage)
-        for line in lines:
-            new_values = cls._recompute_price_by_percentage(line, factor)
-            if new_values:
-                to_write.extend(([line], new_values))
-        if to_write:
-            cls.write(*to_write)
+        return cls._recompute_price_lines(lines,
+            cls._get_recompute_price_values_percentage(percentage))
+
+    @classmethod
+    def _recompute_price_by_rounding(cls, line, step):
+        if not is_numeric_formula(line.formula):
+            return
+        list_price = parse_formula(line.formula)
+        new_list_price = (list_price / step).quantize(
+            Decimal('1.'), rounding=ROUND_HALF_UP) * step
+        values = {
+            'formula': str(new_list_price),
+            }
+        return values
+
+    @classmethod
+    def _get_recompute_price_values_rounding(cls, rounding):
+        if not rounding or rounding <= 0:
+            raise UserError(gettext(
+                    'product_price_list_ar.msg_recompute_rounding_positive',
+                    rounding=rounding))
+        return lambda line: cls._recompute_price_by_rounding(line, rounding)
+
+    @classmethod
+    def recompute_price_by_rounding(cls, lines, rounding):
+        return cls._recompute_price_lines(lines,
+            cls._get_recompute_price_values_rounding(rounding))
+
+    @classmethod
+    def _recompute_price_by_formula_factor(cls, line, factor):
+        if factor == 1:
+            return
+        if is_numeric_formula(line.formula):
+            list_price = parse_formula(line.formula)
+            new_list_price = (list_price * factor).quantize(
+                Decimal(1) / 10 ** price_digits[1], rounding=ROUND_HALF_UP)
+            formula = str(new_list_price)
+        else:
+            formula = '(%s) * %s' % (line.formula, factor)
+        values = {
+            'formula': formula,
+            }
+        return values
+
+    @classmethod
+    def _get_recompute_price_values_formula_factor(cls, factor):
+        factor = quantize_rate(factor, (16, 4))
+        return lambda line: cls._recompute_price_by_formula_factor(
+            line, factor)
+
+    @classmethod
+    def recompute_price_by_formula_factor(cls, lines, factor):
+        return cls._recompute_price_lines(lines,
+            cls._get_recompute_price_values_formula_factor(factor))
+
+    @classmethod
+    def preview_recompute_price(cls, price_list, method, products=None,
+            size=None, **kwargs):
+        '''
+        Yield the line id, product id, old formula, new formula and
+        variation in percentage of the lines of the price list
+        recomputed with method without writing them
+        '''
+        get_values = getattr(
+            cls, '_get_recompute_price_values_%s' % method)(**kwargs)
+        for lines in cls.iter_recompute(price_list, products, size):
+            for line in lines:
+                values = get_values(line) or {}
+                new_formula = values.get('formula', line.formula)
+                delta = None
+                if (is_numeric_formula(line.formula)
+                        and is_numeric_formula(new_formula)
+                        and parse_formula(line.formula)):
+                    old_price = parse_formula(line.formula)
+                    delta = ((parse_formula(new_formula) - old_price)
+                        / old_price * 100).quantize(Decimal('0.01'))
+                yield (line.id, line.product.id if line.product else None,
+                    line.formula, new_formula, delta)
+
+    @classmethod
+    def preview_recompute_price_csv(cls, file, price_lists, method,
+            products=None, size=None, **kwargs):
+        '''
+        Write the preview of the recompute of the price lists into file
+        as CSV
+        Return the number of lines written
+        '''
+        Product = Pool().get('product.product')
+
+        if not size:
+            size = Transaction().database.IN_MAX
+        writer = csv.writer(file)
+        writer.writerow(['price_list', 'line', 'product',
+                'old_formula', 'new_formula', 'delta'])
+        count = 0
+        for price_list in price_lists:
+            preview = cls.preview_recompute_price(
+                price_list, method, products=products, size=size, **kwargs)
+            while True:
+                rows = list(islice(preview, size))
+                if not rows:
+                    break
+                names = {p.id: p.rec_name for p in Product.browse(
+                        {r[1] for r in rows if r[1] is not None})}
+                for line_id, product_id, old, new, delta in rows:
+                    writer.writerow([price_list.rec_name, line_id,
+                            names.get(product_id, ''), old, new,
+                            delta if delta is not None else ''])
+                count += len(rows)
+        return count
+
+    @classmethod
+    def export_csv(cls, file, price_list, size=None):
+        '''
+        Write the product lines of the price list into file as CSV
+        with product code and formula columns by chunks of size
+        Return the number of lines written
+        '''
+        Product = Pool().get('product.product')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        if not size:
+            size = Transaction().database.IN_MAX
+        writer = csv.writer(file)
+        writer.writerow(['product', 'formula'])
+        where = ((table.price_list == price_list.id)
+            & (table.product != Null)
+            & (table.quantity == Null)
+            & (table.category == Null))
+        count = last_id = 0
+        while True:
+            cursor.execute(*table.select(
+                    table.id, table.product, table.formula,
+                    where=where & (table.id > last_id),
+                    order_by=[table.id.asc], limit=size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            codes = {p.id: p.code for p in Product.browse(
+                    list({r[1] for r in rows}))}
+            for _, product, formula in rows:
+                writer.writerow([codes[product] or '', formula])
+            count += len(rows)
+            last_id = rows[-1][0]
+        return count
+
+    @classmethod
+    def import_csv(cls, file, price_list, currency=None, currency_rate=None,
+            size=None):
+        '''
+        Insert or update the lines of the price list from the CSV file
+        with product code and formula columns by chunks of size
+        A product is matched to its line without quantity nor category
+        Numeric formulas are converted from currency to the currency of the
+        price list when they differ
+        Return the number of inserted, updated, unchanged and skipped rows
+        '''
+        Product = Pool().get('product.product')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        if not size:
+            size = config.getint(
+                'product_price_list_ar', 'recompute_size', default=1000)
+        convert = currency and currency != price_list.currency
+        exp = Decimal(1) / 10 ** price_digits[1]
+        reader = csv.DictReader(file)
+        inserted = updated = unchanged = skipped = 0
+        while True:
+            rows = list(islice(reader, size))
+            if not rows:
+                break
+            codes = list({r['product'] for r in rows if r['product']})
+            with Transaction().set_context(active_test=False):
+                products = {p.code: p.id for sub_codes in grouped_slice(codes)
+                    for p in Product.search([
+                            ('code', 'in', list(sub_codes)),
+                            ])}
+
+            lines = {}
+            for sub_ids in grouped_slice(list(set(products.values()))):
+                cursor.execute(*table.select(
+                        table.id, table.product, table.formula,
+                        where=(table.price_list == price_list.id)
+                        & reduce_ids(table.product, list(sub_ids))
+                        & (table.quantity == Null)
+                        & (table.category == Null),
+                        order_by=[table.id.desc]))
+                for id_, product, formula in cursor:
+                    lines[product] = cls(id_, formula=formula, product=product)
+
+            to_create, to_write = {}, {}
+            for row in rows:
+                product = products.get(row['product'])
+                formula = (row['formula'] or '').strip()
+                if product is None or not formula:
+                    skipped += 1
+                    continue
+                if convert and is_numeric_formula(formula):
+                    formula = str(cls.compute_currency(
+                            currency, Decimal(formula), price_list.currency,
+                            currency_rate, round=False).quantize(exp))
+                line = lines.get(product)
+                if line is None:
+                    if product in to_create:
+                        skipped += 1
+                    to_create[product] = formula
+                elif same_formula(line.formula, formula):
+                    unchanged += 1
+                else:
+                    if line in to_write:
+                        skipped += 1
+                    to_write[line] = formula
+
+            if to_create:
+                cls.create([{
+                            'price_list': price_list.id,
+                            'product': product,
+                            'formula': formula,
+                            } for product, formula in to_create.items()])
+                inserted += len(to_create)
+            if to_write:
+                args = []
+                for line, formula in to_write.items():
+                    args.extend(([line], {'formula': formula}))
+                updated += cls._write_recomputed_price(args)
+            logger.info("import price list %s: %s rows processed",
+                price_list.id, inserted + updated + unchanged + skipped)
+        return inserted, updated, unchanged, skipped
 
 
 class Currency(metaclass=PoolMeta):
     __name__ = 'currency.currency'
+    _price_list_rate_cache = Cache('currency.currency.price_list_rate',
+        context=False)
+
+    @classmethod
+    def get_price_list_rate(cls, from_currency, to_currency,
+            currency_rate=None):
+        '''
+        Return the rate to convert an amount from_currency to_currency
+        The currency_rate is used if set, otherwise the rate is computed
+        from the currencies at the date of the context
+        '''
+        Date = Pool().get('ir.date')
+
+        date = Transaction().context.get('date') or Date.today()
+        key = (int(from_currency), int(to_currency), date,
+            str(currency_rate) if currency_rate else None)
+        rate = cls._price_list_rate_cache.get(key)
+        if rate is None:
+            if currency_rate:
+                rate = quantize_rate(currency_rate)
+            else:
+                from_currency = cls(int(from_currency))
+                to_currency = cls(int(to_currency))
+                if from_currency == to_currency or not from_currency.rate:
+                    rate = quantize_rate(1)
+                else:
+                    rate = quantize_rate(
+                        to_currency.rate / from_currency.rate)
+            cls._price_list_rate_cache.set(key, rate)
+        return rate
 
     @classmethod
     def compute(cls, from_currency, amount, to_currency, round=True):
@@ -186,15 +1078,179 @@ class Currency(metaclass=PoolMeta):
         return super().compute(from_currency, amount, to_currency, round)
 
 
+class CurrencyRate(metaclass=PoolMeta):
+    __name__ = 'currency.currency.rate'
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        PriceList = pool.get('product.price_list')
+        rates = super().create(vlist)
+        Currency._price_list_rate_cache.clear()
+        PriceList.queue_refresh_snapshot_currencies(
+            {r.currency for r in rates})
+        cls.queue_reprice_documents({r.currency for r in rates})
+        return rates
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        PriceList = pool.get('product.price_list')
+        rates = sum(args[0:None:2], [])
+        currencies = {r.currency.id for r in rates}
+        super().write(*args)
+        Currency._price_list_rate_cache.clear()
+        currencies.update(
+            r.currency.id for r in cls.browse([r.id for r in rates]))
+        PriceList.queue_refresh_snapshot_currencies(currencies)
+        cls.queue_reprice_documents(currencies)
+
+    @classmethod
+    def delete(cls, rates):
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        PriceList = pool.get('product.price_list')
+        currencies = {r.currency for r in rates}
+        super().delete(rates)
+        Currency._price_list_rate_cache.clear()
+        PriceList.queue_refresh_snapshot_currencies(currencies)
+        cls.queue_reprice_documents(currencies)
+
+    @classmethod
+    def queue_reprice_documents(cls, currencies):
+        '''
+        Push tasks updating the prices of the draft sales and customer
+        invoices with a price list converted from or to the currencies
+        when enabled by the reprice_on_rate option of the
+        product_price_list_ar configuration section
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Sale = pool.get('sale.sale')
+
+        if not config.getboolean(
+                'product_price_list_ar', 'reprice_on_rate', default=False):
+            return
+        currencies = [int(c) for c in currencies]
+        size = config.getint(
+            'product_price_list_ar', 'reprice_size', default=100)
+        for Model, domain in [
+                (Sale, [('state', '=', 'draft')]),
+                (Invoice, [('state', '=', 'draft'), ('type', '=', 'out')]),
+                ]:
+            records = Model.search(domain + [
+                    ('price_list', '!=', None),
+                    ['OR',
+                        ('currency', 'in', currencies),
+                        ('price_list.currency', 'in', currencies),
+                        ],
+                    ], order=[('id', 'ASC')])
+            records = [r for r in records
+                if r.currency != r.price_list.currency]
+            for sub_records in grouped_slice(records, size):
+                Model.__queue__.update_lines_price(list(sub_records))
+
+
+class PriceListSnapshot(ModelSQL, ModelView):
+    'Price List Snapshot'
+    __name__ = 'product.price_list.snapshot'
+
+    price_list = fields.Many2One('product.price_list', 'Price List',
+        required=True, readonly=True, ondelete='CASCADE')
+    product = fields.Many2One('product.product', 'Product',
+        required=True, readonly=True, ondelete='CASCADE')
+    currency = fields.Many2One('currency.currency', 'Currency',
+        required=True, readonly=True, ondelete='CASCADE')
+    quantity = fields.Float('Quantity', required=True, readonly=True,
+        help="The minimal quantity from which the unit price applies.")
+    unit_price = fields.Numeric('Unit Price', digits=price_digits,
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(
+                t,
+                (t.price_list, Index.Range()),
+                (t.currency, Index.Range()),
+                (t.product, Index.Range()),
+                (t.quantity, Index.Range())))
+        cls._order = [
+            ('price_list', 'ASC'),
+            ('product', 'ASC'),
+            ('currency', 'ASC'),
+            ('quantity', 'ASC'),
+            ]
+        cls.__rpc__.update({
+                'get_prices': RPC(),
+                })
+
+    @classmethod
+    def get_prices(cls, price_list, products, currency, quantity=0,
+            uom=None):
+        '''
+        Return the snapshot price of the products of the price list
+        for the quantity in the currency as a dictionary with product id
+        as key
+        The quantity is expressed in uom or in the product sale unit when
+        uom is missing or of another category
+        Products missing from the snapshot are not in the dictionary
+        '''
+        pool = Pool()
+        PriceList = pool.get('product.price_list')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        price_list = PriceList(int(price_list))
+        product_ids = [int(p) for p in products]
+        if uom is not None:
+            uom = Uom(int(uom))
+        quantities = {}
+        for product in Product.browse(product_ids):
+            product_uom = uom or product.sale_uom
+            if product_uom.category != product.sale_uom.category:
+                product_uom = product.sale_uom
+            quantities[product.id] = abs(Uom.compute_qty(product_uom,
+                    quantity or 0, price_list.get_uom(product), round=False))
+
+        prices = {}
+        for sub_ids in grouped_slice(product_ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.select(
+                    table.product, table.quantity, table.unit_price,
+                    where=(table.price_list == price_list.id)
+                    & (table.currency == int(currency))
+                    & reduce_ids(table.product, sub_ids)
+                    & (table.quantity <= max(
+                            quantities[p] for p in sub_ids)),
+                    order_by=[table.product.asc, table.quantity.desc]))
+            for product_id, break_, unit_price in cursor:
+                if (product_id in prices
+                        or break_ > quantities[product_id]):
+                    continue
+                if unit_price is not None:
+                    unit_price = Decimal(str(unit_price))
+                prices[product_id] = unit_price
+        return prices
+
+
 class ProductPriceRecomputeStart(ModelView):
     'Recompute Price List - Start'
     __name__ = 'product.price_list.recompute_price.start'
 
     method = fields.Selection([
-            # ('fixed_amount', 'Fixed Amount'),
+            ('fixed_amount', 'Fixed Amount'),
             ('percentage', 'Percentage'),
+            ('rounding', 'Rounding'),
+            ('formula_factor', 'Formula Factor'),
             ], 'Recompute Method', required=True)
-    percentage = fields.Float('Percentage', digits=(16, 4),
+    percentage = fields.Numeric('Percentage', digits=percentage_digits,
         states={
             'invisible': Eval('method') != 'percentage',
             'required': Eval('method') == 'percentage',
@@ -205,17 +1261,51 @@ class ProductPriceRecomputeStart(ModelView):
             'invisible': Eval('method') != 'fixed_amount',
             'required': Eval('method') == 'fixed_amount',
             }, depends=['method'])
-    price_list = fields.Many2One('product.price_list','Price List',
-        required=True)
+    rounding = fields.Numeric('Rounding', digits=price_digits,
+        domain=['OR',
+            ('rounding', '=', None),
+            ('rounding', '>', 0),
+            ],
+        states={
+            'invisible': Eval('method') != 'rounding',
+            'required': Eval('method') == 'rounding',
+            }, depends=['method'],
+        help="The price step to which the prices are rounded.")
+    factor = fields.Numeric('Factor', digits=(16, 4),
+        states={
+            'invisible': Eval('method') != 'formula_factor',
+            'required': Eval('method') == 'formula_factor',
+            }, depends=['method'],
+        help="The factor by which the formulas are multiplied.")
+    price_lists = fields.Many2Many('product.price_list', None, None,
+        'Price Lists', required=True)
     products = fields.Many2Many('product.product', None, None, 'Products')
+    size = fields.Integer('Chunk Size', required=True,
+        domain=[('size', '>', 0)],
+        help="The number of lines recomputed at once.")
+    queue = fields.Boolean('Queue',
+        help="Recompute the lines in background tasks.")
+
+    @staticmethod
+    def default_size():
+        return config.getint(
+            'product_price_list_ar', 'recompute_size', default=1000)
+
+    @staticmethod
+    def default_queue():
+        return False
 
     @staticmethod
     def default_unit_price():
         return Decimal('0')
 
+    @staticmethod
+    def default_factor():
+        return Decimal('1')
+
     @staticmethod
     def default_percentage():
-        return float(0)
+        return Decimal('0')
 
     @staticmethod
     def default_method():
@@ -230,6 +1320,15 @@ class ProductPriceRecomputeStart(ModelView):
             ]
 
 
+class ProductPriceRecomputeDone(ModelView):
+    'Recompute Price List - Done'
+    __name__ = 'product.price_list.recompute_price.done'
+
+    updated = fields.Integer('Updated Lines', readonly=True)
+    skipped = fields.Integer('Skipped Lines', readonly=True)
+    queued = fields.Integer('Queued Lines', readonly=True)
+
+
 class ProductPriceRecompute(Wizard):
     'Recompute Product Price'
     __name__ = 'product.price_list.recompute_price'
@@ -237,9 +1336,15 @@ class ProductPriceRecompute(Wizard):
     start = StateView('product.price_list.recompute_price.start',
         'product_price_list_ar.price_list_recompute_start_view_form', [
             Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Preview', 'preview', 'tryton-print'),
             Button('Recompute', 'recompute_', 'tryton-ok', default=True),
             ])
+    preview = StateReport('product.price_list.recompute_price.preview')
     recompute_ = StateTransition()
+    done = StateView('product.price_list.recompute_price.done',
+        'product_price_list_ar.price_list_recompute_done_view_form', [
+            Button('OK', 'end', 'tryton-ok', default=True),
+            ])
 
     def get_additional_args(self):
         method_name = 'get_additional_args_%s' % self.start.method
@@ -247,23 +1352,155 @@ class ProductPriceRecompute(Wizard):
             return {}
         return getattr(self, method_name)()
 
+    def get_additional_args_fixed_amount(self):
+        return {
+            'unit_price': self.start.unit_price,
+            }
+
     def get_additional_args_percentage(self):
         return {
             'percentage': self.start.percentage,
             }
 
+    def get_additional_args_rounding(self):
+        return {
+            'rounding': self.start.rounding,
+            }
+
+    def get_additional_args_formula_factor(self):
+        return {
+            'factor': self.start.factor,
+            }
+
+    def do_preview(self, action):
+        return action, {
+            'model': 'product.price_list',
+            'ids': [p.id for p in self.start.price_lists],
+            'method': self.start.method,
+            'products': [p.id for p in self.start.products],
+            'size': self.start.size,
+            'arguments': self.get_additional_args(),
+            }
+
+    def transition_preview(self):
+        return 'start'
+
+    @instrumented('product.price_list.recompute_price')
     def transition_recompute_(self):
         pool = Pool()
         Line = pool.get('product.price_list.line')
 
-        method_name = 'recompute_price_by_%s' % self.start.method
-        method = getattr(Line, method_name)
-        if method:
-            domain = [
-                ('price_list', '=', self.start.price_list)
-            ]
-            if self.start.products:
-                products = [s.id for s in list(self.start.products)]
-                domain.append(('product', 'in', products))
-            method(Line.search(domain), **self.get_additional_args())
-        return 'end'
+        updated, skipped, queued = Line.recompute_price_lists(
+            self.start.price_lists, self.start.method,
+            products=self.start.products, size=self.start.size,
+            queue=self.start.queue, **self.get_additional_args())
+        self.done.updated = updated
+        self.done.skipped = skipped
+        self.done.queued = queued
+        return 'done'
+
+    def default_done(self, fields):
+        return {
+            'updated': self.done.updated,
+            'skipped': self.done.skipped,
+            'queued': self.done.queued,
+            }
+
+
+class ProductPriceRecomputePreview(Report):
+    'Recompute Price List - Preview'
+    __name__ = 'product.price_list.recompute_price.preview'
+
+    @classmethod
+    def execute(cls, ids, data):
+        pool = Pool()
+        Line = pool.get('product.price_list.line')
+        PriceList = pool.get('product.price_list')
+        Product = pool.get('product.product')
+
+        cls.check_access()
+        price_lists = PriceList.browse(ids)
+        file = io.StringIO()
+        Line.preview_recompute_price_csv(file, price_lists, data['method'],
+            products=Product.browse(data.get('products') or []),
+            size=data.get('size'), **data.get('arguments', {}))
+        if len(price_lists) == 1:
+            name = price_lists[0].rec_name
+        else:
+            name = 'price_lists'
+        return ('csv', file.getvalue().encode('utf-8'), False, name)
+
+
+class PriceListImportStart(ModelView):
+    'Import Price List - Start'
+    __name__ = 'product.price_list.import_lines.start'
+
+    price_list = fields.Many2One('product.price_list', 'Price List',
+        required=True)
+    file = fields.Binary('File', required=True,
+        help="A CSV file with product code and formula columns.")
+    currency = fields.Many2One('currency.currency', 'Currency',
+        help="The currency of the prices of the file "
+        "if different from the price list currency.")
+    currency_rate = fields.Numeric('Currency Rate', digits=(12, 6),
+        states={
+            'invisible': ~Eval('currency'),
+            },
+        depends=['currency'])
+    size = fields.Integer('Chunk Size', required=True,
+        domain=[('size', '>', 0)],
+        help="The number of rows imported at once.")
+
+    @staticmethod
+    def default_size():
+        return config.getint(
+            'product_price_list_ar', 'recompute_size', default=1000)
+
+
+class PriceListImportDone(ModelView):
+    'Import Price List - Done'
+    __name__ = 'product.price_list.import_lines.done'
+
+    inserted = fields.Integer('Inserted Lines', readonly=True)
+    updated = fields.Integer('Updated Lines', readonly=True)
+    unchanged = fields.Integer('Unchanged Lines', readonly=True)
+    skipped = fields.Integer('Skipped Rows', readonly=True)
+
+
+class PriceListImport(Wizard):
+    'Import Price List'
+    __name__ = 'product.price_list.import_lines'
+
+    start = StateView('product.price_list.import_lines.start',
+        'product_price_list_ar.price_list_import_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+    done = StateView('product.price_list.import_lines.done',
+        'product_price_list_ar.price_list_import_done_view_form', [
+            Button('OK', 'end', 'tryton-ok', default=True),
+            ])
+
+    def transition_import_(self):
+        pool = Pool()
+        Line = pool.get('product.price_list.line')
+
+        file = io.TextIOWrapper(
+            io.BytesIO(self.start.file), encoding='utf-8-sig', newline='')
+        inserted, updated, unchanged, skipped = Line.import_csv(file,
+            self.start.price_list, currency=self.start.currency,
+            currency_rate=self.start.currency_rate, size=self.start.size)
+        self.done.inserted = inserted
+        self.done.updated = updated
+        self.done.unchanged = unchanged
+        self.done.skipped = skipped
+        return 'done'
+
+    def default_done(self, fields):
+        return {
+            'inserted': self.done.inserted,
+            'updated': self.done.updated,
+            'unchanged': self.done.unchanged,
+            'skipped': self.done.skipped,
+            }
@@ -0,0 +1,26 @@
+# This file is part of product_price_list_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+
+__all__ = ['PricingContext']
+
+
+class PricingContext(tuple):
+    '''
+    Immutable and hashable pricing context
+    It is built like a dictionary and list values are stored as tuples
+    '''
+    __slots__ = ()
+
+    def __new__(cls, context=None, **kwargs):
+        context = dict(context or {}, **kwargs)
+        return super().__new__(cls, sorted(
+                (k, tuple(v) if isinstance(v, list) else v)
+                for k, v in context.items()))
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self))
+
+    def merge(self, context=None, **kwargs):
+        "Return a new pricing context updated with context"
+        return self.__class__(dict(self), **dict(context or {}, **kwargs))
@@ -2,35 +2,84 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 
+from trytond.modules.product import round_price
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
 
+from .stats import instrumented
+
 
 class Product(metaclass=PoolMeta):
     __name__ = 'product.product'
 
     @classmethod
+    @instrumented('product.product.get_sale_price')
     def get_sale_price(cls, products, quantity=0):
         pool = Pool()
         PriceList = pool.get('product.price_list')
         Uom = pool.get('product.uom')
-        Party = pool.get('party.party')
 
-        prices = super().get_sale_price(products, quantity=quantity)
+        context = Transaction().context
+        if not context.get('price_list'):
+            return super().get_sale_price(products, quantity=quantity)
+
+        price_list = PriceList(context['price_list'])
+        defined = price_list.products_defined(products)
+        others = [p for p in products if p.id not in defined]
+        prices = {}
+        if others:
+            prices.update(super().get_sale_price(others, quantity=quantity))
+
+        uom = None
+        if context.get('uom'):
+            uom = Uom(context.get('uom'))
+        listed = [p for p in products if p.id in defined]
+        unit_prices = {}
+        if (listed and price_list.snapshot
+                and context.get('price_list_snapshot')
+                and context.get('currency')
+                and not context.get('currency_rate')):
+            unit_prices.update(price_list.get_snapshot_prices(
+                    listed, quantity, uom))
+            listed = [p for p in listed if p.id not in unit_prices]
+        if listed:
+            unit_prices.update(price_list.compute_many(listed, quantity, uom))
+        prices.update(cls._get_price_list_sale_prices(
+                price_list, unit_prices, uom))
+        return prices
+
+    @classmethod
+    def _get_price_list_sale_prices(cls, price_list, unit_prices, uom=None):
+        '''
+        Return the sale prices from the unit prices computed by the price
+        list as a dictionary with product id as key
+        It is get_sale_price without the conversion from the company
+        currency as the price list prices are already in the currency
+        of the context
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Tax = pool.get('account.tax')
+        Uom = pool.get('product.uom')
 
         context = Transaction().context
-        if context.get('price_list'):
-            price_list = PriceList(context['price_list'])
-            uom = None
-            if context.get('uom'):
-                uom = Uom(context.get('uom'))
-            if context.get('customer'):
-                customer = Party(context['customer'])
-            else:
-                customer = None
-            for product in products:
-                price = price_list.compute(customer, product,
-                    prices[product.id], quantity, uom)
-                prices[product.id] = price
+        taxes = None
+        if price_list.tax_included and context.get('taxes'):
+            taxes = Tax.browse(context['taxes'])
+        today = Date.today()
 
+        prices = {}
+        for product in cls.browse(list(unit_prices)):
+            unit_price = unit_prices[product.id]
+            if unit_price is not None:
+                if taxes:
+                    unit_price = Tax.reverse_compute(unit_price, taxes, today)
+                if uom and product.default_uom.category == uom.category:
+                    unit_price = Uom.compute_price(
+                        product.default_uom, unit_price, uom)
+                else:
+                    unit_price = Uom.compute_price(
+                        product.default_uom, unit_price, product.sale_uom)
+                unit_price = round_price(unit_price)
+            prices[product.id] = unit_price
         return prices
@@ -1,11 +1,16 @@
 # This file is part of product_price_list_ar module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from collections import defaultdict
 from decimal import Decimal
 
 from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.transaction import Transaction
+
+from .price_list import quantize_rate, rate_digits
+from .pricing import PricingContext
 
 
 class Sale(metaclass=PoolMeta):
@@ -18,11 +23,56 @@ class Sale(metaclass=PoolMeta):
 
     @fields.depends('currency', 'company')
     def on_change_currency(self):
+        digits = self.__class__.currency_rate.digits or rate_digits
         if self.currency and self.currency.rate:
-            self.currency_rate = (
-                self.company.currency.rate / self.currency.rate)
+            self.currency_rate = quantize_rate(
+                self.company.currency.rate / self.currency.rate, digits)
         else:
-            self.currency_rate = Decimal('1.0')
+            self.currency_rate = quantize_rate(1, digits)
+
+    @classmethod
+    def update_lines_price(cls, sales):
+        '''
+        Update the unit price of the lines of the draft sales with their
+        price list, lines sharing the same pricing context are priced at once
+        Return the lines that changed
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        SaleLine = pool.get('sale.line')
+
+        sales = [s for s in sales if s.state == 'draft' and s.price_list]
+        groups = defaultdict(lambda: defaultdict(list))
+        for sale in sales:
+            lines = [l for l in sale.lines if l.type == 'line' and l.product]
+            defined = sale.price_list.products_defined(
+                [l.product for l in lines])
+            for line in lines:
+                if line.product.id not in defined:
+                    continue
+                context = PricingContext(line._get_context_sale_price())
+                groups[context, abs(line.quantity or 0)][
+                    line.product].append(line)
+
+        digits = SaleLine.unit_price.digits[1]
+        to_save = []
+        for (context, quantity), product_lines in groups.items():
+            with Transaction().set_context(dict(context)):
+                prices = Product.get_sale_price(
+                    list(product_lines), quantity)
+            for product, lines in product_lines.items():
+                unit_price = prices[product.id]
+                if unit_price is not None:
+                    unit_price = unit_price.quantize(
+                        Decimal(1) / 10 ** digits)
+                for line in lines:
+                    if line.unit_price != unit_price:
+                        line.unit_price = unit_price
+                        to_save.append(line)
+
+        if to_save:
+            SaleLine.save(to_save)
+        return to_save
 
     def create_invoice(self):
         invoice = super().create_invoice()
@@ -41,26 +91,9 @@ class Line(metaclass=PoolMeta):
         cls.product.context['currency_rate'] = Eval(
             '_parent_sale', {}).get('currency_rate')
 
-    @fields.depends('sale', '_parent_sale.price_list',
-        '_parent_sale.currency')
+    @fields.depends('sale', '_parent_sale.currency_rate')
     def _get_context_sale_price(self):
         context = super()._get_context_sale_price()
-        if self.sale:
-            if getattr(self.sale, 'price_list', None):
-                context['price_list_currency'] = (
-                    self.sale.price_list.currency.id)
-            if getattr(self.sale, 'currency', None):
-                context['currency_rate'] = self.sale.currency_rate
+        if self.sale and getattr(self.sale, 'currency_rate', None):
+            context['currency_rate'] = self.sale.currency_rate
         return context
-
-    @fields.depends('_parent_sale.price_list', '_parent_sale.currency_rate')
-    def on_change_product(self):
-        super().on_change_product()
-
-    @fields.depends('_parent_sale.price_list', '_parent_sale.currency_rate')
-    def on_change_quantity(self):
-        super().on_change_quantity()
-
-    @fields.depends('_parent_sale.price_list', '_parent_sale.currency_rate')
-    def on_change_unit(self):
-        super().on_change_unit()
@@ -0,0 +1,122 @@
+# This file is part of product_price_list_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['instrumented', 'get_stats', 'reset_stats']
+
+logger = logging.getLogger(__name__)
+_lock = threading.Lock()
+_stats = defaultdict(lambda: {'calls': 0, 'time': 0., 'queries': 0})
+_local = threading.local()
+
+
+def _enabled():
+    return Transaction().context.get('price_list_stats',
+        config.getboolean('product_price_list_ar', 'stats', default=False))
+
+
+class _Cursor(object):
+    "Cursor counting the executed queries"
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        _local.queries += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        _local.queries += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _Connection(object):
+    "Connection returning counting cursors"
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self, *args, **kwargs):
+        return _Cursor(self._connection.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def instrumented(name):
+    '''
+    Record the calls, wall time and SQL queries of the decorated function
+    when enabled by the price_list_stats context key
+    or the stats option of the product_price_list_ar configuration section
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled():
+                return func(*args, **kwargs)
+            transaction = Transaction()
+            outermost = not getattr(_local, 'depth', 0)
+            if outermost:
+                _local.depth = 0
+                _local.queries = 0
+                _local.calls = defaultdict(
+                    lambda: {'calls': 0, 'time': 0., 'queries': 0})
+                connection = transaction.connection
+                transaction.connection = _Connection(connection)
+            _local.depth += 1
+            queries = _local.queries
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats = _local.calls[name]
+                stats['calls'] += 1
+                stats['time'] += time.perf_counter() - start
+                stats['queries'] += _local.queries - queries
+                _local.depth -= 1
+                if outermost:
+                    transaction.connection = connection
+                    calls, _local.calls = _local.calls, None
+                    with _lock:
+                        for key, values in calls.items():
+                            for k, v in values.items():
+                                _stats[key][k] += v
+                    logger.info("%s: %s", name, ', '.join(
+                            '%s %s calls %.4fs %s queries' % (
+                                key, v['calls'], v['time'], v['queries'])
+                            for key, v in sorted(calls.items())))
+        return wrapper
+    return decorator
+
+
+def get_stats():
+    "Return the statistics recorded since the start or the last reset"
+    with _lock:
+        return {k: dict(v) for k, v in _stats.items()}
+
+
+def reset_stats():
+    "Reset the recorded statistics"
+    with _lock:
+        _stats.clear()
@@ -0,0 +1,239 @@
+# This file is part of product_price_list_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Benchmark of the price list pricing chain
+
+It runs by default on a SQLite database in memory:
+
+    python -m trytond.modules.product_price_list_ar.tests.benchmark \\
+        --sizes 1000 10000 100000 --output benchmark.json
+'''
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+from decimal import Decimal
+
+os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+
+from trytond import __version__, backend  # noqa: E402
+from trytond.cache import Cache  # noqa: E402
+from trytond.modules.account.tests import create_chart  # noqa: E402
+from trytond.modules.company.tests import (  # noqa: E402
+    create_company, set_company)
+from trytond.modules.currency.tests import (  # noqa: E402
+    add_currency_rate, create_currency)
+from trytond.modules.product_price_list_ar.price_list import (  # noqa: E402
+    quantize_rate)
+from trytond.pool import Pool  # noqa: E402
+from trytond.tests.test_tryton import (  # noqa: E402
+    DB_NAME, USER, activate_module)
+from trytond.transaction import Transaction  # noqa: E402
+
+MODULE = 'product_price_list_ar'
+
+
+def timed(function, repeat=3):
+    "Return the best and mean wall time of repeat calls of function"
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {
+        'best': min(timings),
+        'mean': sum(timings) / len(timings),
+        'repeat': repeat,
+        }
+
+
+def setup(size):
+    "Create a company in ARS with a USD price list of size lines"
+    pool = Pool()
+    Account = pool.get('account.account')
+    Category = pool.get('product.category')
+    Invoice = pool.get('account.invoice')
+    Party = pool.get('party.party')
+    PriceList = pool.get('product.price_list')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    ars = create_currency('ars')
+    add_currency_rate(ars, Decimal(1))
+    usd = create_currency('usd')
+    add_currency_rate(usd, Decimal('0.001'))
+    eur = create_currency('eur')
+    add_currency_rate(eur, Decimal('0.0009'))
+    company = create_company(currency=ars)
+    with set_company(company):
+        create_chart(company)
+    receivable, = Account.search([
+            ('type.receivable', '=', True),
+            ('company', '=', company.id),
+            ])
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('company', '=', company.id),
+            ])
+    expense, = Account.search([
+            ('type.expense', '=', True),
+            ('company', '=', company.id),
+            ])
+    unit, = Uom.search([('name', '=', 'Unit')])
+    category, = Category.create([{
+                'name': 'Account',
+                'accounting': True,
+                'account_revenue': revenue.id,
+                'account_expense': expense.id,
+                }])
+    templates = Template.create([{
+                'name': 'Product %s' % i,
+                'default_uom': unit.id,
+                'sale_uom': unit.id,
+                'salable': True,
+                'list_price': Decimal(i % 1000 + 1),
+                'account_category': category.id,
+                'products': [('create', [{}])],
+                } for i in range(size)])
+    products = [t.products[0] for t in templates]
+
+    price_lists = PriceList.create([{
+                'name': 'Price List %s' % currency.code,
+                'company': company.id,
+                'currency': currency.id,
+                'lines': [('create', [{
+                                'product': p.id,
+                                'formula': str(i % 500 + 1),
+                                } for i, p in enumerate(products)])],
+                } for currency in [usd, eur]])
+    party, = Party.create([{
+                'name': 'Customer',
+                'account_receivable': receivable.id,
+                'addresses': [('create', [{}])],
+                }])
+
+    invoice_size = min(size, 400)
+    invoice, = Invoice.create([{
+                'type': 'out',
+                'company': company.id,
+                'party': party.id,
+                'invoice_address': party.addresses[0].id,
+                'currency': ars.id,
+                'currency_rate': Decimal(1000),
+                'account': receivable.id,
+                'price_list': price_lists[0].id,
+                'lines': [('create', [{
+                                'product': p.id,
+                                'quantity': 1,
+                                'unit': unit.id,
+                                'unit_price': Decimal(0),
+                                'account': revenue.id,
+                                } for p in products[:invoice_size]])],
+                }])
+    return company, ars, party, products, price_lists, invoice
+
+
+def run(size, repeat):
+    pool = Pool()
+    Invoice = pool.get('account.invoice')
+    Line = pool.get('product.price_list.line')
+    PriceList = pool.get('product.price_list')
+    Product = pool.get('product.product')
+    Sale = pool.get('sale.sale')
+    SaleLine = pool.get('sale.line')
+
+    company, ars, party, products, price_lists, invoice = setup(size)
+    price_list = price_lists[0]
+    results = []
+
+    def add(name, timing, count):
+        timing.update(name=name, size=size, count=count)
+        results.append(timing)
+
+    price = Decimal('1234.56')
+    for name, rate in [
+            ('multiply_full_rate', Decimal(1) / Decimal('0.000689')),
+            ('multiply_quantized_rate',
+                quantize_rate(Decimal(1) / Decimal('0.000689'))),
+            ]:
+        add(name, timed(lambda: [price * rate for _ in range(size)], repeat),
+            size)
+
+    with set_company(company), Transaction().set_context(
+            price_list=price_list.id, currency=ars.id,
+            currency_rate=Decimal(1000), customer=party.id,
+            sale_date=datetime.date.today()):
+        sale = Sale(company=company, party=party, currency=ars,
+            price_list=price_list, currency_rate=Decimal(1000))
+
+        def on_change_product():
+            line = SaleLine(sale=sale, type='line', quantity=1,
+                product=products[len(products) // 2])
+            line.on_change_product()
+        add('sale_line_on_change_product',
+            timed(on_change_product, repeat), 1)
+
+        add('get_sale_price',
+            timed(lambda: Product.get_sale_price(products), repeat),
+            len(products))
+
+        def get_sale_price_each():
+            for product in products:
+                Product.get_sale_price([product], 1)
+        add('get_sale_price_each', timed(get_sale_price_each, repeat),
+            len(products))
+
+    items = [(p.id, 1, None) for p in products]
+    with set_company(company):
+        add('quote',
+            timed(lambda: PriceList.quote(price_list.id, items, ars.id,
+                    currency_rate=Decimal(1000), customer=party.id),
+                repeat),
+            len(items))
+
+        add('invoice_update_lines_price',
+            timed(lambda: Invoice.update_lines_price([invoice]), repeat),
+            len(invoice.lines))
+
+        add('recompute_price_list',
+            timed(lambda: Line.recompute_price_list(
+                    price_list, 'percentage', percentage=0.01), repeat),
+            size)
+    return results
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', nargs='+', type=int,
+        default=[1000, 10000, 100000],
+        help="the number of price list lines")
+    parser.add_argument('--repeat', type=int, default=3,
+        help="the number of runs of each benchmark")
+    parser.add_argument('--output', type=argparse.FileType('w'),
+        default=sys.stdout, help="the JSON file of the results")
+    options = parser.parse_args(arguments)
+
+    activate_module(MODULE)
+    results = []
+    for size in options.sizes:
+        with Transaction().start(DB_NAME, USER, context={}) as transaction:
+            try:
+                results.extend(run(size, options.repeat))
+            finally:
+                transaction.rollback()
+                Cache.drop(DB_NAME)
+    json.dump({
+            'module': MODULE,
+            'trytond': __version__,
+            'backend': backend.name,
+            'date': datetime.datetime.now().isoformat(),
+            'results': results,
+            }, options.output, indent=2)
+    options.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
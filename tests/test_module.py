@@ -1,13 +1,527 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import io
+from decimal import Decimal
+from unittest.mock import patch
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.exceptions import UserError
+from trytond.modules.account.tests import create_chart
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.modules.currency.tests import (
+    add_currency_rate, create_currency)
+from trytond.modules.product_price_list_ar.price_list import (
+    quantize_rate, rate_digits)
+from trytond.modules.product_price_list_ar.stats import (
+    get_stats, instrumented, reset_stats)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+def create_products(codes):
+    "Create a product for each code"
+    pool = Pool()
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    templates = Template.create([{
+                'name': code,
+                'code': code,
+                'default_uom': unit.id,
+                'salable': True,
+                'sale_uom': unit.id,
+                'list_price': Decimal(0),
+                'products': [('create', [{}])],
+                } for code in codes])
+    return [t.products[0] for t in templates]
+
+
+def run_tasks():
+    "Run the queued tasks of the transaction"
+    Queue = Pool().get('ir.queue')
+    transaction = Transaction()
+    while transaction.tasks:
+        Queue(transaction.tasks.pop(0)).run()
 
 
 class ProductPriceListTestCase(CompanyTestMixin, ModuleTestCase):
     'Test product_price_list_ar module'
     module = 'product_price_list_ar'
 
+    def test_quantize_rate(self):
+        'Test quantize_rate'
+        exp = -rate_digits[1]
+        for rate in [0.1, Decimal(1) / Decimal(3), 1000, '0.0009']:
+            with self.subTest(rate=rate):
+                self.assertEqual(
+                    quantize_rate(rate).as_tuple().exponent, exp)
+        self.assertEqual(quantize_rate(0.1), Decimal('0.1'))
+        self.assertEqual(quantize_rate(0.0125, (16, 4)), Decimal('0.0125'))
+
+    @with_transaction()
+    def test_recompute_price_by_percentage(self):
+        'Test recompute price by percentage from a float'
+        pool = Pool()
+        Line = pool.get('product.price_list.line')
+
+        # float 0.3 is 0.29999999999999998889776975...
+        get_values = Line._get_recompute_price_values_percentage(0.3)
+        self.assertEqual(get_values(Line(formula='5')), {'formula': '7'})
+        get_values = Line._get_recompute_price_values_percentage(
+            Decimal('0.3'))
+        self.assertEqual(get_values(Line(formula='5')), {'formula': '7'})
+
+    @with_transaction()
+    def test_recompute_price(self):
+        'Test recompute price methods'
+        pool = Pool()
+        Line = pool.get('product.price_list.line')
+        PriceList = pool.get('product.price_list')
+
+        company = create_company()
+        with set_company(company):
+            product, = create_products(['P1'])
+            price_list, = PriceList.create([{'name': 'List'}])
+
+            def create_lines(formulas):
+                Line.delete(Line.search([('price_list', '=', price_list.id)]))
+                return Line.create([{
+                            'price_list': price_list.id,
+                            'product': product.id,
+                            'formula': formula,
+                            } for formula in formulas])
+
+            def formulas(lines):
+                # Instantiate the lines again to read the stored values
+                return [l.formula for l in Line.browse([l.id for l in lines])]
+
+            for method, kwargs, before, after, result in [
+                    ('percentage', {'percentage': Decimal('0.1')},
+                        ['10', '20', 'unit_price * 2'],
+                        ['11', '22', 'unit_price * 2'], (2, 1)),
+                    ('rounding', {'rounding': Decimal(5)},
+                        ['12.30', '15', 'unit_price'],
+                        ['10', '15', 'unit_price'], (1, 2)),
+                    ('formula_factor', {'factor': Decimal(2)},
+                        ['10', 'unit_price * 2'],
+                        ['20.0000', '(unit_price * 2) * 2.0000'], (2, 0)),
+                    ('fixed_amount', {'unit_price': Decimal(7)},
+                        ['10', '7.00', 'unit_price'],
+                        ['7', '7.00', '7'], (2, 1)),
+                    ]:
+                with self.subTest(method=method):
+                    lines = create_lines(before)
+                    # Fill the cache of the lines
+                    self.assertEqual(formulas(lines), before)
+                    self.assertEqual(getattr(
+                            Line, 'recompute_price_by_%s' % method)(
+                            lines, **kwargs), result)
+                    self.assertEqual(formulas(lines), after)
+                    self.assertEqual(
+                        [l.formula for l in Line.search(
+                                [('price_list', '=', price_list.id)],
+                                order=[('id', 'ASC')])],
+                        after)
+
+            line1, line2, line3 = create_lines(['10', '20', '30'])
+            self.assertEqual(formulas([line1]), ['10'])
+            self.assertEqual(Line._write_recomputed_price([
+                        [line1], {'formula': '12'},
+                        [line2], {'formula': 'unit_price'},
+                        [line3], {'formula': '12', 'sequence': 5},
+                        ]), 3)
+            self.assertEqual(
+                formulas([line1, line2, line3]), ['12', 'unit_price', '12'])
+            self.assertEqual(Line(line3.id).sequence, 5)
+
+            lines = create_lines(['10', 'unit_price * 2'])
+            self.assertEqual(
+                Line.recompute_price_by_formula_factor(lines, 1), (0, 2))
+            self.assertEqual(formulas(lines), ['10', 'unit_price * 2'])
+            with self.assertRaises(UserError):
+                Line.recompute_price_by_rounding(lines, 0)
+
+    @with_transaction()
+    def test_get_line(self):
+        'Test get_line finds the line of the linear scan'
+        pool = Pool()
+        Category = pool.get('product.category')
+        Line = pool.get('product.price_list.line')
+        PriceList = pool.get('product.price_list')
+        Template = pool.get('product.template')
+
+        company = create_company()
+        with set_company(company):
+            parent, = Category.create([{'name': 'Parent'}])
+            child, = Category.create([{
+                        'name': 'Child',
+                        'parent': parent.id,
+                        }])
+            product1, product2, product3 = create_products(
+                ['P1', 'P2', 'P3'])
+            Template.write([product1.template], {
+                    'categories': [('add', [child.id])],
+                    }, [product2.template], {
+                    'categories': [('add', [parent.id])],
+                    })
+            price_list, = PriceList.create([{'name': 'List'}])
+            Line.create([{
+                        'price_list': price_list.id,
+                        'sequence': sequence,
+                        'product': product,
+                        'category': category,
+                        'quantity': quantity,
+                        'formula': str(sequence),
+                        } for sequence, product, category, quantity in [
+                        (10, product1.id, None, 10),
+                        (20, None, child.id, 0),
+                        (30, product1.id, None, 5),
+                        (40, product1.id, None, 5),
+                        (50, None, parent.id, 20),
+                        (60, None, None, None),
+                        (70, None, None, 100),
+                        (80, product2.id, parent.id, 1),
+                        ]])
+            patterns = [{
+                    'product': product.id,
+                    'categories': categories,
+                    'quantity': quantity,
+                    } for product, categories in [
+                    (product1, [child.id, parent.id]),
+                    (product2, [parent.id]),
+                    (product3, []),
+                    ] for quantity in [0, 1, 5, 10, 20, 100, -10]]
+
+            def check():
+                price_list_ = PriceList(price_list.id)
+                for pattern in patterns:
+                    with self.subTest(pattern=pattern):
+                        for expected in price_list_.lines:
+                            if expected.match(pattern):
+                                break
+                        else:
+                            expected = None
+                        self.assertEqual(
+                            price_list_.get_line(pattern), expected)
+
+            check()
+            lines = Line.search([('price_list', '=', price_list.id)])
+            line10, line20, line30, line40, line50, line60 = lines[:6]
+
+            # Reorder the lines
+            Line.write([line60], {'sequence': 1}, [line40], {'sequence': 5})
+            check()
+            Line.write([line10], {'quantity': 0})
+            check()
+            Line.create([{
+                        'price_list': price_list.id,
+                        'sequence': 0,
+                        'product': product2.id,
+                        'quantity': 20,
+                        'formula': '0',
+                        }])
+            check()
+            Line.delete([line60, line20])
+            check()
+
+    @with_transaction()
+    def test_instrumented_cursor(self):
+        'Test instrumented calls count the queries of cursor contexts'
+
+        @instrumented('test')
+        def query():
+            with Transaction().connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                return cursor.fetchone()
+
+        reset_stats()
+        with Transaction().set_context(price_list_stats=True):
+            self.assertEqual(query(), (1,))
+        self.assertEqual(get_stats()['test']['queries'], 1)
+
+    @with_transaction()
+    def test_recompute_price_wizard_stats(self):
+        'Test recompute price wizard with statistics'
+        pool = Pool()
+        Line = pool.get('product.price_list.line')
+        PriceList = pool.get('product.price_list')
+        Recompute = pool.get('product.price_list.recompute_price', 'wizard')
+
+        company = create_company()
+        with set_company(company):
+            product, = create_products(['P1'])
+            price_list, = PriceList.create([{
+                        'name': 'List',
+                        'lines': [('create', [{
+                                        'product': product.id,
+                                        'formula': '10',
+                                        }])],
+                        }])
+
+            reset_stats()
+            session_id, _, _ = Recompute.create()
+            with Transaction().set_context(price_list_stats=True):
+                result = Recompute.execute(session_id, {
+                        'start': {
+                            'method': 'percentage',
+                            'percentage': Decimal('0.1'),
+                            'price_lists': [price_list.id],
+                            'products': [],
+                            'size': 10,
+                            'queue': False,
+                            },
+                        }, 'recompute_')
+            Recompute.delete(session_id)
+
+            self.assertEqual(result['view']['defaults']['updated'], 1)
+            line, = Line.search([('price_list', '=', price_list.id)])
+            self.assertEqual(Decimal(line.formula), Decimal(11))
+            stats = get_stats()['product.price_list.recompute_price']
+            self.assertEqual(stats['calls'], 1)
+            self.assertGreater(stats['queries'], 0)
+
+    @with_transaction()
+    def test_snapshot(self):
+        'Test price list snapshot'
+        pool = Pool()
+        Line = pool.get('product.price_list.line')
+        PriceList = pool.get('product.price_list')
+        Rate = pool.get('currency.currency.rate')
+        Snapshot = pool.get('product.price_list.snapshot')
+        Uom = pool.get('product.uom')
+
+        ars = create_currency('ARS')
+        add_currency_rate(ars, Decimal(1))
+        usd = create_currency('USD')
+        usd_rate = add_currency_rate(usd, Decimal('0.001'))
+        company = create_company(currency=ars)
+        dozen, = Uom.search([('name', '=', 'Dozen')])
+        with set_company(company):
+            product1, product2 = create_products(['P1', 'P2'])
+            price_list, = PriceList.create([{
+                        'name': 'USD',
+                        'currency': usd.id,
+                        'snapshot': True,
+                        }])
+            line1, line2, line3 = Line.create([{
+                        'price_list': price_list.id,
+                        'product': product.id,
+                        'quantity': quantity,
+                        'formula': formula,
+                        } for product, quantity, formula in [
+                        (product1, 12, '8'),
+                        (product1, 0, '10'),
+                        (product2, 0, '5'),
+                        ]])
+            run_tasks()
+
+            def get_prices(currency, quantity=0, uom=None):
+                return Snapshot.get_prices(price_list,
+                    [product1, product2], currency, quantity, uom)
+
+            self.assertEqual(Snapshot.search([
+                        ('price_list', '=', price_list.id),
+                        ('currency', '=', usd.id),
+                        ], count=True), 3)
+            self.assertEqual(get_prices(usd, 1), {
+                    product1.id: Decimal(10),
+                    product2.id: Decimal(5),
+                    })
+            self.assertEqual(get_prices(usd, 12), {
+                    product1.id: Decimal(8),
+                    product2.id: Decimal(5),
+                    })
+            self.assertEqual(get_prices(usd, -12)[product1.id], Decimal(8))
+            self.assertEqual(get_prices(usd, 1, dozen)[product1.id],
+                Decimal(8))
+            self.assertEqual(get_prices(ars)[product1.id], Decimal(10000))
+
+            Line.write([line3], {'formula': '6'})
+            run_tasks()
+            self.assertEqual(get_prices(usd), {
+                    product1.id: Decimal(10),
+                    product2.id: Decimal(6),
+                    })
+
+            Rate.write([usd_rate], {'rate': Decimal('0.002')})
+            run_tasks()
+            self.assertEqual(get_prices(ars), {
+                    product1.id: Decimal(5000),
+                    product2.id: Decimal(3000),
+                    })
+
+            Line.delete([line1])
+            run_tasks()
+            self.assertEqual(get_prices(usd, 12)[product1.id], Decimal(10))
+
+    @with_transaction()
+    def test_invoice_update_line_price(self):
+        'Test update line price of invoices'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        Party = pool.get('party.party')
+        PriceList = pool.get('product.price_list')
+        UpdatePrice = pool.get('invoice.update_line_price', 'wizard')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            receivable, = Account.search([
+                    ('type.receivable', '=', True),
+                    ('company', '=', company.id),
+                    ])
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('company', '=', company.id),
+                    ])
+            product1, product2 = create_products(['P1', 'P2'])
+            price_list, = PriceList.create([{
+                        'name': 'List',
+                        'lines': [('create', [{
+                                        'product': product1.id,
+                                        'formula': '10',
+                                        }, {
+                                        'product': product2.id,
+                                        'formula': '20',
+                                        }])],
+                        }])
+            party, = Party.create([{
+                        'name': 'Customer',
+                        'account_receivable': receivable.id,
+                        'addresses': [('create', [{}])],
+                        }])
+            invoice1, invoice2 = Invoice.create([{
+                        'type': 'out',
+                        'party': party.id,
+                        'invoice_address': party.addresses[0].id,
+                        'account': receivable.id,
+                        'price_list': price_list.id,
+                        'lines': [('create', [{
+                                        'product': product.id,
+                                        'quantity': 1,
+                                        'unit': product.default_uom.id,
+                                        'unit_price': Decimal(unit_price),
+                                        'account': revenue.id,
+                                        } for product, unit_price in lines])],
+                        } for lines in [
+                        [(product1, 0), (product2, 20)],
+                        [(product1, 10), (product2, 20)],
+                        ]])
+
+            session_id, _, _ = UpdatePrice.create()
+            with patch.object(Invoice, 'update_taxes') as update_taxes, \
+                    patch.object(InvoiceLine, 'save',
+                        wraps=InvoiceLine.save) as save, \
+                    Transaction().set_context(
+                        active_model='account.invoice',
+                        active_ids=[invoice1.id, invoice2.id],
+                        active_id=invoice1.id):
+                result = UpdatePrice.execute(session_id, {}, 'update')
+            UpdatePrice.delete(session_id)
+
+            self.assertEqual(result['view']['defaults']['lines'], 1)
+            save.assert_called_once_with([invoice1.lines[0]])
+            update_taxes.assert_called_once_with([invoice1])
+            self.assertEqual(
+                [l.unit_price
+                    for i in Invoice.browse([invoice1.id, invoice2.id])
+                    for l in i.lines],
+                [Decimal(10), Decimal(20), Decimal(10), Decimal(20)])
+
+    @with_transaction()
+    def test_quote(self):
+        'Test quote of items'
+        pool = Pool()
+        PriceList = pool.get('product.price_list')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        dozen, = Uom.search([('name', '=', 'Dozen')])
+        with set_company(company):
+            product1, product2, product3 = create_products(['P1', 'P2', 'P3'])
+            price_list, = PriceList.create([{
+                        'name': 'List',
+                        'lines': [('create', [{
+                                        'product': product.id,
+                                        'quantity': quantity,
+                                        'formula': formula,
+                                        } for product, quantity, formula in [
+                                        (product1, 10, '8'),
+                                        (product1, 0, '10'),
+                                        (product2, 0, '20'),
+                                        ]])],
+                        }])
+            currency = company.currency
+            items = [
+                (product1.id, 1),
+                (product2.id, 1, dozen.id),
+                (product1.id, 12, None),
+                (product3.id, 1),
+                (product1.id, 1, dozen.id),
+                (product2.id, 24, product2.default_uom.id),
+                ]
+
+            expected = []
+            for product, quantity, *uom in items:
+                with Transaction().set_context(
+                        price_list=price_list.id, currency=currency.id,
+                        uom=uom[0] if uom else None):
+                    expected.append(Product.get_sale_price(
+                            [Product(product)], quantity)[product])
+
+            self.assertEqual(
+                PriceList.quote(price_list.id, items, currency.id), expected)
+            self.assertEqual(expected[:3],
+                [Decimal(10), Decimal(240), Decimal(8)])
+            self.assertEqual(expected[4], Decimal(96))
+            self.assertEqual(
+                PriceList.quote(
+                    price_list.id, items, currency.id, offset=2, limit=3),
+                expected[2:5])
+            self.assertEqual(
+                PriceList.quote(price_list.id, items, currency.id, offset=4),
+                expected[4:])
+
+    @with_transaction()
+    def test_import_csv_currency(self):
+        'Test import_csv converts prices to the price list currency'
+        pool = Pool()
+        Line = pool.get('product.price_list.line')
+        PriceList = pool.get('product.price_list')
+
+        ars = create_currency('ARS')
+        add_currency_rate(ars, Decimal(1))
+        usd = create_currency('USD')
+        add_currency_rate(usd, Decimal('0.001'))
+        company = create_company(currency=ars)
+        with set_company(company):
+            product, = create_products(['P1'])
+            price_list, = PriceList.create([{
+                        'name': 'USD',
+                        'currency': usd.id,
+                        }])
+
+            for currency_rate in [None, Decimal(1000)]:
+                with self.subTest(currency_rate=currency_rate):
+                    Line.delete(
+                        Line.search([('price_list', '=', price_list.id)]))
+                    result = Line.import_csv(
+                        io.StringIO('product,formula\nP1,1000\n'),
+                        price_list, currency=ars,
+                        currency_rate=currency_rate)
+                    self.assertEqual(result, (1, 0, 0, 0))
+                    line, = Line.search([('price_list', '=', price_list.id)])
+                    self.assertEqual(Decimal(line.formula), Decimal(1))
+
+            result = Line.import_csv(
+                io.StringIO('product,formula\nP1,1\nP2,3\n'),
+                price_list)
+            self.assertEqual(result, (0, 0, 1, 1))
+
 
 del ModuleTestCase